@@ -1,23 +1,60 @@
 import os
-import io
+import re
 import csv
 import zipfile
 import tempfile
-import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 import numpy as np
+import orjson
+import pyarrow as pa
+from pyarrow import csv as arrow_csv
 from datetime import datetime
-from flask import Flask, request, jsonify, render_template_string
+from numba import njit, types
+from flask import Flask, Response, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 from werkzeug.utils import secure_filename
 
+def engine_options(database_uri):
+    url = make_url(database_uri)
+    backend, driver = url.get_backend_name(), url.get_driver_name()
+    options = {'insertmanyvalues_page_size': 5000}
+    if backend != 'sqlite':
+        options.update(pool_size=10, max_overflow=20, pool_pre_ping=True)
+    if backend == 'postgresql' and driver == 'psycopg2':
+        options['executemany_mode'] = 'values_plus_batch'
+    if backend == 'mssql' and driver == 'pyodbc':
+        options['fast_executemany'] = True
+    return options
+
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'omniscient-divine-key')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///omniscience.db')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB
+app.config['MAX_ZIP_MEMBER_SIZE'] = 512 * 1024 * 1024  # 512MB uncompressed per CSV in a ZIP
+app.config['INGEST_BATCH_SIZE'] = int(os.getenv('INGEST_BATCH', '10000'))
 db = SQLAlchemy(app)
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL with synchronous=NORMAL fsyncs on checkpoint rather than on every commit
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-65536')
+    cursor.close()
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
 class Omniscience(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=True)
@@ -46,139 +83,229 @@ class Omniscience(db.Model):
     def to_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
-def add_delta_and_oscillator(df, col, window=5):
-    if col not in df.columns:
-        return df
-    df[col] = pd.to_numeric(df[col], errors='coerce')
-    df[f'delta_{col}'] = df[col].diff()
-    df[f'oscillator_{col}'] = (df[col] - df[col].rolling(window).mean()) / (df[col].rolling(window).std() + 1e-6)
-    return df
+# Stat counts (swings, whiffs, ...) parse as int32; the id primary key stays int64 since SQLite
+# rowids are 64-bit. Floats stay float64 because REAL/double columns would persist float32 noise.
+CSV_DTYPES = {db.Float: pa.float64(), db.Integer: pa.int32(), db.Boolean: pa.bool_(), db.String: pa.string()}
+MODEL_COLS = frozenset(Omniscience.__table__.columns.keys())
+# Filled in by the database or the model when left out of an insert
+DEFAULTED_COLS = frozenset(c.name for c in Omniscience.__table__.columns if c.primary_key or c.default is not None)
+# Rebuilt by engineer_features, so never read from the CSV
+DERIVED_COLS = frozenset({'cashout_signal', 'pick_tracked'})
+MODEL_DTYPES = {c.name: pa.int64() if c.primary_key else CSV_DTYPES[type(c.type)]
+                for c in Omniscience.__table__.columns if type(c.type) in CSV_DTYPES}
+class CorruptCSVError(Exception):
+    pass
+
+# Only failures caused by the uploaded bytes; anything else gets a generic 'Error processing' alert
+CORRUPT_INPUT_ERRORS = (CorruptCSVError, pa.ArrowInvalid, UnicodeDecodeError, csv.Error, zipfile.BadZipFile)
+# CSVs may end lines with \n, \r\n or a bare \r
+LINE_END = re.compile(rb'[\r\n]')
+PARSE_WORKERS = 8
+# Names secure_filename would return unchanged (no leading/trailing '.' or '_')
+SAFE_FILENAME = re.compile(r'[A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?')
 
-def engineer_features(df):
+# Eager signature compiles at import; input is read-only since Arrow returns zero-copy buffers.
+# No fastmath: it assumes no NaNs, and blank cells and the warm-up window depend on them.
+@njit(types.UniTuple(types.float64[:], 2)(types.Array(types.float64, 1, 'A', readonly=True), types.int64),
+      cache=True, error_model='numpy')
+def oscillator_kernel(x, window):
+    # Single pass producing diff() and the rolling z-score (ddof=1, NaN until the window fills)
+    n = x.shape[0]
+    delta = np.empty(n)
+    oscillator = np.empty(n)
+    for i in range(n):
+        delta[i] = x[i] - x[i - 1] if i > 0 else np.nan
+        if i < window - 1:
+            oscillator[i] = np.nan
+            continue
+        mean = 0.0
+        m2 = 0.0
+        for k in range(window):
+            value = x[i - window + 1 + k]
+            diff = value - mean
+            mean += diff / (k + 1)
+            m2 += diff * (value - mean)
+        oscillator[i] = (x[i] - mean) / (np.sqrt(m2 / (window - 1)) + 1e-6)
+    return delta, oscillator
+
+def delta_and_oscillator(table, col, window=5):
+    if col not in table.column_names:
+        return {}
+    delta, oscillator = oscillator_kernel(table.column(col).to_numpy(), window)
+    return {f'delta_{col}': delta, f'oscillator_{col}': oscillator}
+
+def engineer_features(table):
+    features = {}
     for col in ['avg_bat_speed']:
-        df = add_delta_and_oscillator(df, col)
-    if 'oscillator_avg_bat_speed' in df.columns:
-        df['cashout_signal'] = df['oscillator_avg_bat_speed'] < -2
-    df['pick_tracked'] = True
-    return df
+        features.update(delta_and_oscillator(table, col))
+    if 'oscillator_avg_bat_speed' in features:
+        features['cashout_signal'] = features['oscillator_avg_bat_speed'] < -2
+    features['pick_tracked'] = np.ones(table.num_rows, dtype=bool)
+    for name, values in features.items():
+        # from_pandas=True stores NaN as null, which to_pylist() turns into None
+        table = table.append_column(name, pa.array(values, from_pandas=True))
+    return table
 
-def is_csv_corrupted(file_obj):
-    try:
-        pos = file_obj.tell()
-        reader = csv.reader(io.TextIOWrapper(file_obj, encoding='utf-8'))
-        header = next(reader, None)
-        first_row = next(reader, None)
-        file_obj.seek(pos)
-        if not header or not first_row:
-            return True, "Empty or missing data"
-        if len(header) != len(first_row):
-            return True, f"Header has {len(header)} columns, row has {len(first_row)}"
-        return False, None
-    except Exception as e:
-        file_obj.seek(0)
-        return True, str(e)
+def column_or(table, name, default):
+    return table.column(name) if name in table.column_names else pa.array([default] * table.num_rows)
 
-def is_zip_corrupted(file_obj):
-    try:
-        pos = file_obj.tell()
-        with zipfile.ZipFile(file_obj, 'r') as zipf:
-            file_list = zipf.namelist()
-            if not file_list:
-                return True, "ZIP is empty"
-            for filename in file_list:
-                try:
-                    zipf.getinfo(filename)
-                except:
-                    return True, f"Cannot read file info for {filename}"
-        file_obj.seek(pos)
-        return False, None
-    except zipfile.BadZipFile as e:
-        file_obj.seek(0)
-        return True, f"Bad ZIP file: {str(e)}"
-    except Exception as e:
-        file_obj.seek(0)
-        return True, str(e)
+def ojson(obj, status=200):
+    return Response(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC),
+                    status=status, mimetype='application/json')
 
 @app.route('/upload_stats', methods=['POST'])
 def upload_stats():
     if 'files' not in request.files:
-        return jsonify({'error': 'No files provided'}), 400
-    files = request.files.getlist('files')
+        return ojson({'error': 'No files provided'}, 400)
+    files = [f for f in request.files.getlist('files') if f.filename != '']
     alerts = []
     results = []
     try:
-        for file_storage in files:
-            if file_storage.filename == '':
-                continue
-            filename = secure_filename(file_storage.filename)
-            file_obj = file_storage
-            if filename.endswith('.zip'):
-                corrupted, error_msg = is_zip_corrupted(file_obj)
-                if corrupted:
-                    alerts.append(f"Corrupted ZIP: {filename} - {error_msg}")
-                    continue
-                file_obj.seek(0)
-                try:
-                    with zipfile.ZipFile(file_obj, 'r') as zipf:
-                        for zipinfo in zipf.infolist():
-                            if zipinfo.filename.endswith('.csv'):
-                                try:
-                                    with zipf.open(zipinfo) as csvfile:
-                                        corrupted, error_msg = is_csv_corrupted(csvfile)
-                                        if corrupted:
-                                            alerts.append(f"Corrupted CSV in ZIP: {zipinfo.filename} - {error_msg}")
-                                            continue
-                                        csvfile.seek(0)
-                                        results.extend(process_csv(csvfile, zipinfo.filename))
-                                except Exception as e:
-                                    alerts.append(f"Error processing {zipinfo.filename}: {str(e)}")
-                except Exception as e:
-                    alerts.append(f"Error processing ZIP {filename}: {str(e)}")
-            elif filename.endswith('.csv'):
-                corrupted, error_msg = is_csv_corrupted(file_obj)
-                if corrupted:
-                    alerts.append(f"Corrupted CSV: {filename} - {error_msg}")
-                    continue
-                file_obj.seek(0)
-                results.extend(process_csv(file_obj, filename))
-            else:
-                alerts.append(f"Unsupported file type: {filename}")
-        db.session.commit()
-        return jsonify({
+        # Parsing overlaps across worker threads; inserts stay on this thread's session.
+        # At most PARSE_WORKERS parsed CSVs are held at once, each inserted as soon as it
+        # is ready, so memory tracks the largest few CSVs rather than the whole upload.
+        with ExitStack() as stack, ThreadPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+            pending = deque()
+            for job in csv_jobs(files, alerts, stack):
+                pending.append(pool.submit(parse_job, *job))
+                if len(pending) >= PARSE_WORKERS:
+                    ingest(pending.popleft().result(), alerts, results)
+            while pending:
+                ingest(pending.popleft().result(), alerts, results)
+        response = {
             'status': 'INGESTION COMPLETE',
             'alerts': alerts,
             'results': results,
             'files_processed': len(results)
-        })
+        }
+        if request.args.get('include_stats') == '1':
+            # Lets clients skip the follow-up GET /api/omniscience_stats round-trip
+            response['latest'] = latest_stats()
+        return ojson(response)
     except Exception as e:
         db.session.rollback()
-        return jsonify({'error': f'Server error: {str(e)}'}), 500
+        return ojson({'error': f'Server error: {str(e)}'}, 500)
 
-def process_csv(file_obj, filename):
-    results = []
+def csv_jobs(files, alerts, stack):
+    # Yields (filename, read, corrupt_label) for every CSV in the upload; ZIPs stay open on stack
+    for file_storage in files:
+        name = file_storage.filename
+        filename = name if SAFE_FILENAME.fullmatch(name) else secure_filename(name)
+        if filename.endswith('.zip'):
+            try:
+                zipf = stack.enter_context(zipfile.ZipFile(file_storage, 'r'))
+                members = zipf.infolist()
+            except zipfile.BadZipFile as e:
+                alerts.append(f"Corrupted ZIP: {filename} - Bad ZIP file: {str(e)}")
+                continue
+            except Exception as e:
+                alerts.append(f"Error processing ZIP {filename}: {str(e)}")
+                continue
+            if not members:
+                alerts.append(f"Corrupted ZIP: {filename} - ZIP is empty")
+            for zipinfo in members:
+                if not zipinfo.filename.endswith('.csv'):
+                    continue
+                if zipinfo.file_size > app.config['MAX_ZIP_MEMBER_SIZE']:
+                    alerts.append(f"Error processing {zipinfo.filename}: "
+                                  f"{zipinfo.file_size} bytes uncompressed exceeds the member size limit")
+                    continue
+                yield zipinfo.filename, partial(zipf.read, zipinfo), 'Corrupted CSV in ZIP'
+        elif filename.endswith('.csv'):
+            yield filename, file_storage.read, 'Corrupted CSV'
+        else:
+            alerts.append(f"Unsupported file type: {filename}")
+
+def parse_job(filename, read, corrupt_label):
+    # Runs on a worker thread, so it must not touch db.session
+    try:
+        return filename, parse_csv(read()), None
+    except CORRUPT_INPUT_ERRORS as e:
+        return filename, None, f"{corrupt_label}: {filename} - {str(e)}"
+    except Exception as e:
+        return filename, None, f"Error processing {filename}: {str(e)}"
+
+def ingest(job_result, alerts, results):
+    filename, parsed, alert = job_result
+    if alert:
+        alerts.append(alert)
+        return
+    records, file_results = parsed
     try:
-        df = pd.read_csv(file_obj)
-        df = engineer_features(df)
-        for _, row in df.iterrows():
-            data = {col: row.get(col) for col in Omniscience.__table__.columns.keys() if col in row and not pd.isna(row[col])}
-            data['timestamp'] = datetime.utcnow()
-            omni = Omniscience(**data)
-            db.session.add(omni)
-            results.append({
-                'id': row.get('id', 'unknown'),
-                'name': row.get('name', 'unknown'),
-                'avg_bat_speed': row.get('avg_bat_speed'),
-                'cashout_signal': bool(row.get('cashout_signal', False)),
-                'oscillator_bat_speed': row.get('oscillator_avg_bat_speed')
-            })
+        insert_records(records)
+        db.session.commit()
+        results.extend(file_results)
     except Exception as e:
-        raise Exception(f"Error processing {filename}: {str(e)}")
-    return results
+        db.session.rollback()
+        alerts.append(f"Error processing {filename}: {str(e)}")
+
+def read_model_csv(raw):
+    # Sniff the header so pyarrow only converts the model's columns
+    end = LINE_END.search(raw)
+    header = next(csv.reader([(raw if end is None else raw[:end.start()]).decode('utf-8-sig')]), [])
+    if not header:
+        raise CorruptCSVError("Empty or missing data")
+    include_columns = [col for col in header if col in MODEL_COLS and col not in DERIVED_COLS]
+    if not include_columns:
+        # An empty include_columns list would make pyarrow convert every column
+        raise CorruptCSVError("No recognised stat columns in header")
+    convert_options = arrow_csv.ConvertOptions(
+        include_columns=include_columns,
+        column_types=MODEL_DTYPES,
+        strings_can_be_null=True
+    )
+    # BufferReader parses the bytes in place, without Python-level read() calls
+    table = arrow_csv.read_csv(pa.BufferReader(raw), convert_options=convert_options)
+    if table.num_rows == 0:
+        raise CorruptCSVError("Empty or missing data")
+    return table
+
+def parse_csv(raw):
+    # Errors propagate unwrapped; parse_job labels them with the filename
+    table = read_model_csv(raw)
+    table = engineer_features(table)
+    records = table.select([col for col in table.column_names if col in MODEL_COLS]).to_pylist()
+    timestamp = datetime.utcnow()
+    for record in records:
+        record['timestamp'] = timestamp
+    # A blank cell in a defaulted column (e.g. id) must be omitted, not sent as NULL,
+    # so the autoincrement/default still applies; insert_records groups rows by key set
+    blank_defaults = [col for col in DEFAULTED_COLS
+                      if col in table.column_names and table.column(col).null_count]
+    if blank_defaults:
+        for record in records:
+            for col in blank_defaults:
+                if record[col] is None:
+                    del record[col]
+    results = pa.table({
+        'id': column_or(table, 'id', 'unknown'),
+        'name': column_or(table, 'name', 'unknown'),
+        'avg_bat_speed': column_or(table, 'avg_bat_speed', None),
+        'cashout_signal': column_or(table, 'cashout_signal', False),
+        'oscillator_bat_speed': column_or(table, 'oscillator_avg_bat_speed', None)
+    }).to_pylist()
+    return records, results
+
+def insert_records(records):
+    batch_size = app.config['INGEST_BATCH_SIZE']
+    if db.engine.dialect.name == 'postgresql':
+        batch_size = min(batch_size, 1000)  # PostgreSQL gains little past ~1k rows per batch
+    # executemany needs every row in a batch to bind the same columns
+    groups = {}
+    for record in records:
+        groups.setdefault(tuple(record), []).append(record)
+    for rows in groups.values():
+        for start in range(0, len(rows), batch_size):
+            db.session.execute(Omniscience.__table__.insert(), rows[start:start + batch_size])
+
+def latest_stats(limit=100):
+    # Core select over the table: rows come back as plain mappings without ORM identity-map work
+    query = db.select(Omniscience.__table__).order_by(Omniscience.timestamp.desc()).limit(limit)
+    return [dict(s) for s in db.session.execute(query).mappings().all()]
 
 @app.route('/api/omniscience_stats', methods=['GET'])
 def omniscience_stats():
-    stats = Omniscience.query.order_by(Omniscience.timestamp.desc()).limit(100).all()
-    return jsonify([s.to_dict() for s in stats])
+    return ojson(latest_stats())
 
 if __name__ == '__main__':
     with app.app_context():